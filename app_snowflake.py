@@ -1,7 +1,31 @@
+import functools
+import inspect
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
+import plotly.graph_objects as go
 from sqlalchemy import create_engine
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+logger = logging.getLogger(__name__)
+
+# Number of worker threads main() runs Snowflake queries on; the engine pool
+# has one more connection for the queries main() runs itself
+QUERY_WORKERS = 4
+# Tables with more houses than this get density heatmaps instead of scatter plots
+SCATTER_MAX_POINTS = 50_000
+
+# Statement logging formats every query, so it's opt-in via SQL_DEBUG=1
+if os.environ.get("SQL_DEBUG") == "1":
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG)
 
 def get_secrets():
     """Retrieve Snowflake connection secrets."""
@@ -17,39 +41,252 @@ def create_engine_url(config):
         f'{config["database"]}/{config["schema"]}?warehouse={config["warehouse"]}'
     )
 
-def load_data(engine):
-    """Load data from Snowflake into a pandas DataFrame."""
-    query = 'SELECT * FROM PROPERTY_DATA.HOUSES;'
+@st.cache_resource(show_spinner=False)
+def get_engine(engine_url):
+    """Create the Snowflake SQLAlchemy engine once per server process."""
+    return create_engine(engine_url, echo=False, pool_pre_ping=True, pool_recycle=3600,
+                         pool_size=QUERY_WORKERS + 1)
+
+def run_query(engine, query):
+    """Run a query and fetch the result as a pandas DataFrame."""
+    # Go through the connector's cursor so results arrive as Arrow batches
+    # (fetch_pandas_all) instead of Python row tuples via pd.read_sql, and keep
+    # the columns Arrow-backed rather than converting them to NumPy/objects.
+    conn = engine.raw_connection()
     try:
-        df = pd.read_sql(query, engine)
-        return df
-    except Exception as e:
-        st.error(f"Error loading data: {e}")
+        # Close the cursor so its result buffers are freed before the
+        # connection goes back to the pool
+        with conn.cursor() as cur:
+            logger.debug("Running query: %s", query)
+            cur.execute(query)
+            return cur.fetch_pandas_all(types_mapper=pd.ArrowDtype)
+    finally:
+        conn.close()
+
+def bucket_sql(column, lo, hi, bins):
+    """Build the SQL assigning `column` to one of `bins` equal-width buckets over [lo, hi]."""
+    # WIDTH_BUCKET puts the maximum in bucket bins + 1, so fold it into the last
+    # one. It has no valid range when every value is the same (lo = hi), so
+    # NULLIF turns that case into NULL and everything falls into bucket 1.
+    bins = int(bins)
+    return f"COALESCE(LEAST(WIDTH_BUCKET({column}, {lo}, NULLIF({hi}, {lo}), {bins}), {bins}), 1)"
+
+def bucket_centers(bucket, lo, hi, bins):
+    """Map WIDTH_BUCKET numbers back to the midpoints of their buckets."""
+    # With a single distinct value (lo == hi) the width is 0 and every bucket
+    # collapses onto that value
+    width = (hi - lo) / bins
+    return lo + (bucket - 0.5) * width
+
+def as_array(series):
+    """Convert an Arrow-backed numeric column to a float NumPy array for Plotly."""
+    # Nulls become NaN, which Plotly skips; pd.NA objects wouldn't serialize
+    return series.to_numpy(dtype='float64', na_value=np.nan)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_table_version(_engine):
+    """Return a fingerprint of PROPERTY_DATA.HOUSES that changes with its data."""
+    # SHOW is answered from metadata, so unlike a query on INFORMATION_SCHEMA
+    # it doesn't need a warehouse (or resume a suspended one). Its result isn't
+    # Arrow, so it's read as a plain row rather than through run_query.
+    conn = _engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SHOW TABLES LIKE 'HOUSES' IN SCHEMA PROPERTY_DATA;")
+            row = cur.fetchone()
+            columns = [column[0] for column in cur.description]
+    finally:
+        conn.close()
+    if row is None:
         return None
+    # Row count and size change with the data; created_on changes if the
+    # table is replaced
+    table = dict(zip(columns, row))
+    return f"{table['created_on']}/{table['rows']}/{table['bytes']}"
+
+@st.cache_resource(show_spinner=False)
+def get_version_state():
+    """Hold the last table version and cache key seen, shared by every session."""
+    return {'lock': threading.Lock()}
+
+def get_cache_key(version_check):
+    """Return the key for this run's loads, clearing results persisted under older keys."""
+    version_state = get_version_state()
+    with version_state['lock']:
+        # Only a server's first run waits on the check; later runs load with the
+        # last version seen, and refresh_table_version stores the new one
+        if 'version' not in version_state:
+            version_state['version'] = version_check.result()
+        if version_state['version'] is None:
+            # Without a version the key would never change, so don't persist
+            return None
+        # The date is a backstop for changes the version misses
+        cache_key = (version_state['version'], date.today().isoformat())
+        if version_state.setdefault('cache_key', cache_key) != cache_key:
+            # Delete the pickles written under older keys so they don't pile up
+            # on disk. A restarted server keeps them until its first key change,
+            # so results persisted before the restart can still be reused
+            load_persisted.clear()
+            version_state['cache_key'] = cache_key
+        return cache_key
+
+def refresh_table_version(version_check):
+    """Store the result of this run's version check for the next run."""
+    try:
+        table_version = version_check.result()
+    except Exception:
+        # This run's data was loaded with the last version seen, so a failed
+        # check only delays picking up a change
+        logger.warning("Checking the version of PROPERTY_DATA.HOUSES failed", exc_info=True)
+        return
+    version_state = get_version_state()
+    with version_state['lock']:
+        version_state['version'] = table_version
+
+@functools.cache
+def loader_source(loader):
+    """Return a loader's source code, which stands in for the loader in cache keys."""
+    return inspect.getsource(loader)
+
+# The loaders below run through cached_load, keyed on the table version and
+# today's date. The version is refreshed at the end of each run, so a change
+# to the table shows from the run after the one in which get_table_version's
+# one-minute cache expired, and nothing is served for more than a day.
+# Results are persisted to disk so a restarted server doesn't have to
+# re-query Snowflake (persisted caches don't support a TTL; the key takes its
+# place). Errors are raised rather than returned so a failed load isn't
+# cached. max_entries covers the queries main() runs for one key.
 
-def preprocess_data(df):
-    """Preprocess the DataFrame for analysis."""
-    df.rename(columns={
-        'price': 'PRICE', 
-        'housetype': 'HOUSETYPE', 
-        'size': 'SIZE', 
-        'lotsize': 'LOTSIZE', 
-        'balcony': 'BALCONY', 
-        'livingspace': 'LIVINGSPACE', 
-        'numberrooms': 'NUMBERROOMS', 
-        'yearbuilt': 'YEARBUILT', 
-        'locality': 'LOCALITY', 
-        'postalcode': 'POSTALCODE'
-    }, inplace=True)
-
-    df['PRICE'] = pd.to_numeric(df['PRICE'], errors='coerce').round(2)
-    df = df[df['PRICE'] > 0]
-    return df
-
-def plot_price_distribution(df):
-    """Plot the distribution of house prices."""
-    fig = px.histogram(df, x="PRICE", nbins=20, title="Price Distribution")
+@st.cache_data(persist="disk", max_entries=5, show_spinner=False)
+def load_persisted(_loader, _engine, source, cache_key, args, kwargs):
+    """Run a loader, persisting its result to disk under `cache_key`."""
+    return _loader(_engine, *args, **kwargs)
+
+@st.cache_data(ttl=3600, max_entries=5, show_spinner=False)
+def load_unversioned(_loader, _engine, source, args, kwargs):
+    """Run a loader, caching its result in memory for an hour."""
+    return _loader(_engine, *args, **kwargs)
+
+def cached_load(loader, engine, cache_key, *args, **kwargs):
+    """Run a loader through the cache that suits `cache_key`."""
+    # The loader itself is unhashable, so its source stands in: like
+    # st.cache_data's own key, a changed loader misses results from the old one
+    if cache_key is None:
+        return load_unversioned(loader, engine, loader_source(loader), args, kwargs)
+    return load_persisted(loader, engine, loader_source(loader), cache_key, args, kwargs)
+
+def load_data(engine, max_points=SCATTER_MAX_POINTS):
+    """Load a sample of the rows used by the scatter plots from Snowflake."""
+    # Sample in Snowflake so at most `max_points` rows are transferred and held
+    # in memory, however large the table grows. Only the plotted columns are
+    # selected, and filtering and rounding happen here too, so the result needs
+    # no client-side cleaning.
+    query = f"""
+        SELECT * FROM (
+            SELECT LIVINGSPACE, NUMBERROOMS, YEARBUILT, ROUND(PRICE, 2) AS PRICE
+            FROM PROPERTY_DATA.HOUSES
+            WHERE PRICE > 0
+        ) SAMPLE ({int(max_points)} ROWS);
+    """
+    return run_query(engine, query)
+
+def load_house_type_counts(engine):
+    """Count the houses of each type in Snowflake."""
+    query = """
+        SELECT HOUSETYPE, COUNT(*) AS NUM_HOUSES
+        FROM PROPERTY_DATA.HOUSES
+        WHERE PRICE > 0
+        GROUP BY HOUSETYPE;
+    """
+    return run_query(engine, query)
+
+def load_locality_prices(engine, limit=5):
+    """Load the most and least expensive localities by average price."""
+    # Both ends share one aggregation; ORDER BY ... LIMIT lets Snowflake use a
+    # top-k selection for each instead of ranking every locality
+    query = f"""
+        WITH MEANS AS (
+            SELECT LOCALITY, AVG(PRICE) AS AVG_PRICE
+            FROM PROPERTY_DATA.HOUSES
+            WHERE PRICE > 0 AND LOCALITY IS NOT NULL
+            GROUP BY LOCALITY
+        )
+        SELECT * FROM (
+            SELECT LOCALITY, ROUND(AVG_PRICE, 2) AS PRICE, TRUE AS EXPENSIVE
+            FROM MEANS ORDER BY AVG_PRICE DESC LIMIT {int(limit)}
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT LOCALITY, ROUND(AVG_PRICE, 2) AS PRICE, FALSE AS EXPENSIVE
+            FROM MEANS ORDER BY AVG_PRICE ASC LIMIT {int(limit)}
+        );
+    """
+    df = run_query(engine, query)
+    # UNION ALL doesn't preserve order, so re-sort the (at most `limit`) rows
+    expensive = df['EXPENSIVE'].fillna(False)
+    most_expensive = df[expensive].sort_values('PRICE', ascending=False)
+    cheapest = df[~expensive].sort_values('PRICE')
+    columns = ['LOCALITY', 'PRICE']
+    return most_expensive[columns], cheapest[columns]
+
+def load_price_histogram(engine, bins=20):
+    """Bin house prices into equal-width buckets in Snowflake."""
+    query = f"""
+        WITH PRICES AS (
+            SELECT PRICE FROM PROPERTY_DATA.HOUSES WHERE PRICE > 0
+        ), BOUNDS AS (
+            SELECT MIN(PRICE) AS LO, MAX(PRICE) AS HI FROM PRICES
+        )
+        SELECT {bucket_sql('PRICE', 'LO', 'HI', bins)} AS BUCKET,
+               ANY_VALUE(LO) AS LO, ANY_VALUE(HI) AS HI, COUNT(*) AS NUM_HOUSES
+        FROM PRICES, BOUNDS
+        GROUP BY BUCKET
+        ORDER BY BUCKET;
+    """
+    df = run_query(engine, query)
+    df['PRICE'] = bucket_centers(df['BUCKET'], df['LO'], df['HI'], bins).round(2)
+    width = (df['HI'] - df['LO']) / bins
+    # A zero-width bar would be invisible; any positive width fills the
+    # autoscaled axis when there's a single bucket
+    df['WIDTH'] = width.where(width > 0, 1)
+    return df[['PRICE', 'WIDTH', 'NUM_HOUSES']]
+
+def load_density(engine, x, y, x_bins=50, y_bins=50):
+    """Count houses on a grid over two columns in Snowflake."""
+    # An axis with `bins=None` is grouped on its exact values, which suits
+    # discrete columns like NUMBERROOMS better than equal-width buckets
+    x_bucket = 'X' if x_bins is None else bucket_sql('X', 'X_LO', 'X_HI', x_bins)
+    y_bucket = 'Y' if y_bins is None else bucket_sql('Y', 'Y_LO', 'Y_HI', y_bins)
+    query = f"""
+        WITH POINTS AS (
+            SELECT {x} AS X, {y} AS Y FROM PROPERTY_DATA.HOUSES
+            WHERE PRICE > 0 AND {x} IS NOT NULL AND {y} IS NOT NULL
+        ), BOUNDS AS (
+            SELECT MIN(X) AS X_LO, MAX(X) AS X_HI, MIN(Y) AS Y_LO, MAX(Y) AS Y_HI
+            FROM POINTS
+        )
+        SELECT {x_bucket} AS X_BUCKET, {y_bucket} AS Y_BUCKET,
+               ANY_VALUE(X_LO) AS X_LO, ANY_VALUE(X_HI) AS X_HI,
+               ANY_VALUE(Y_LO) AS Y_LO, ANY_VALUE(Y_HI) AS Y_HI,
+               COUNT(*) AS NUM_HOUSES
+        FROM POINTS, BOUNDS
+        GROUP BY X_BUCKET, Y_BUCKET;
+    """
+    # `x` and `y` are formatted into the SQL, so they must be trusted identifiers
+    df = run_query(engine, query)
+    df[x] = df['X_BUCKET'] if x_bins is None else bucket_centers(df['X_BUCKET'], df['X_LO'], df['X_HI'], x_bins)
+    df[y] = df['Y_BUCKET'] if y_bins is None else bucket_centers(df['Y_BUCKET'], df['Y_LO'], df['Y_HI'], y_bins)
+    return df[[x, y, 'NUM_HOUSES']]
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def make_price_distribution(price_hist):
+    """Build the price distribution histogram."""
+    # Explicit widths keep each bar spanning its bucket even when neighbouring
+    # buckets are empty (and so missing from the result)
+    fig = go.Figure(go.Bar(x=as_array(price_hist["PRICE"]), y=as_array(price_hist["NUM_HOUSES"]),
+                           width=as_array(price_hist["WIDTH"])))
     fig.update_layout(
+        title="Price Distribution",
         xaxis_title='Price (CHF)',
         yaxis_title='Count',
         xaxis_tickprefix='$',
@@ -65,32 +302,50 @@ def plot_price_distribution(df):
         align="center"
     )
     fig.update_layout(title_x=0.5)  # Center title
-    st.plotly_chart(fig)
-
-def plot_house_type_distribution(df):
-    """Plot the distribution of house types."""
-    fig = px.pie(df, names='HOUSETYPE', title="House Type Distribution")
-    st.plotly_chart(fig)
-
-def plot_living_space_vs_rooms(df):
-    """Plot Living Space vs. Number of Rooms."""
-    fig = px.scatter(df, x="LIVINGSPACE", y="NUMBERROOMS",
-                      title="Living Space vs. Number of Rooms",
-                      labels={"LIVINGSPACE": "Living Space (m²)", "NUMBERROOMS": "Number of Rooms"})
-    st.plotly_chart(fig)
-
-def plot_year_built_vs_price(df):
-    """Plot Year Built vs. Price."""
-    fig = px.scatter(df, x="YEARBUILT", y="PRICE",
-                      title="Year Built vs. Price",
-                      labels={"YEARBUILT": "Year Built", "PRICE": "Price (CHF)"})
-    st.plotly_chart(fig)
-
-def plot_top_expensive_localities(df):
-    """Plot the top 5 most expensive localities."""
-    mean_prices = df.groupby('LOCALITY')['PRICE'].mean().dropna().round(2)
-    top_5_expensive = mean_prices.nlargest(5).reset_index()
+    return fig
 
+@st.cache_resource(max_entries=1, show_spinner=False)
+def make_house_type_distribution(house_type_counts):
+    """Build the house type pie chart."""
+    fig = px.pie(house_type_counts, names='HOUSETYPE', values='NUM_HOUSES',
+                 title="House Type Distribution")
+    return fig
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def make_density_heatmap(density, x, y, title, labels):
+    """Build a heatmap from counts pre-binned by load_density."""
+    fig = go.Figure(go.Heatmap(x=as_array(density[x]), y=as_array(density[y]),
+                               z=as_array(density['NUM_HOUSES']),
+                               colorscale='Blues', colorbar=dict(title='Count')))
+    fig.update_layout(title=title, xaxis_title=labels[x], yaxis_title=labels[y])
+    return fig
+
+def make_living_space_vs_rooms(df, density=None):
+    """Build the Living Space vs. Number of Rooms scatter plot (or heatmap)."""
+    title = "Living Space vs. Number of Rooms"
+    labels = {"LIVINGSPACE": "Living Space (m²)", "NUMBERROOMS": "Number of Rooms"}
+    if density is not None:
+        return make_density_heatmap(density, "LIVINGSPACE", "NUMBERROOMS", title, labels)
+    # 'auto' switches to WebGL past 1000 points and keeps SVG for small frames
+    fig = px.scatter(x=as_array(df["LIVINGSPACE"]), y=as_array(df["NUMBERROOMS"]),
+                      render_mode='auto', title=title,
+                      labels={"x": labels["LIVINGSPACE"], "y": labels["NUMBERROOMS"]})
+    return fig
+
+def make_year_built_vs_price(df, density=None):
+    """Build the Year Built vs. Price scatter plot (or heatmap)."""
+    title = "Year Built vs. Price"
+    labels = {"YEARBUILT": "Year Built", "PRICE": "Price (CHF)"}
+    if density is not None:
+        return make_density_heatmap(density, "YEARBUILT", "PRICE", title, labels)
+    fig = px.scatter(x=as_array(df["YEARBUILT"]), y=as_array(df["PRICE"]),
+                      render_mode='auto', title=title,
+                      labels={"x": labels["YEARBUILT"], "y": labels["PRICE"]})
+    return fig
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def make_top_expensive_localities(top_5_expensive):
+    """Build the bar chart of the top 5 most expensive localities."""
     fig = px.bar(top_5_expensive, x='LOCALITY', y='PRICE', color='LOCALITY',
                   title='Top 5 Most Expensive Localities',
                   labels={'PRICE': 'Average Price (CHF)', 'LOCALITY': 'Locality'},
@@ -99,13 +354,11 @@ def plot_top_expensive_localities(df):
     fig.update_layout(xaxis_title='Locality', yaxis_title='Average Price (CHF)',
                        showlegend=False)
     fig.update_traces(texttemplate='%{text:.2f}', textposition='outside')
-    st.plotly_chart(fig)
-
-def plot_top_cheap_localities(df):
-    """Plot the top 5 cheapest localities."""
-    mean_prices = df.groupby('LOCALITY')['PRICE'].mean().dropna().round(2)
-    top_5_cheap = mean_prices.nsmallest(5).reset_index()
+    return fig
 
+@st.cache_resource(max_entries=1, show_spinner=False)
+def make_top_cheap_localities(top_5_cheap):
+    """Build the bar chart of the top 5 cheapest localities."""
     fig = px.bar(top_5_cheap, x='LOCALITY', y='PRICE', color='LOCALITY',
                   title='Top 5 Cheapest Localities',
                   labels={'PRICE': 'Average Price (CHF)', 'LOCALITY': 'Locality'},
@@ -114,7 +367,7 @@ def plot_top_cheap_localities(df):
     fig.update_layout(xaxis_title='Locality', yaxis_title='Average Price (CHF)',
                        showlegend=False)
     fig.update_traces(texttemplate='%{text:.2f}', textposition='outside')
-    st.plotly_chart(fig)
+    return fig
 
 def main():
     """Main function to run the Streamlit app."""
@@ -124,6 +377,7 @@ def main():
     st.markdown("""
     Welcome to the Swiss Real Estate Dashboard! This application provides insights into the Swiss property market through various visualizations. 
     Explore the distribution of house prices, types of houses, and the relationship between living space, number of rooms, and year built. 
+    For datasets of more than 50,000 houses, these relationships are shown as density heatmaps rather than scatter plots.
     Additionally, view the most and least expensive localities to make informed real estate decisions.
 
     The dataset used for this dashboard is sourced from Kaggle. You can find the dataset [here](https://www.kaggle.com/datasets/etiennekaiser/switzerland-house-price-prediction-data/data).
@@ -137,23 +391,54 @@ def main():
         return
     
     # Create the SQLAlchemy engine
-    engine_url = create_engine_url(config)
-    engine = create_engine(engine_url, echo=False)
-    
-    # Load and preprocess the data
-    df = load_data(engine)
-    if df is None:
-        return
+    engine = get_engine(create_engine_url(config))
     
-    df = preprocess_data(df)
+    # Load the data; aggregations run in Snowflake so only small results come back
+    with st.spinner("Loading houses…"):
+        try:
+            # The queries are independent and wait on the network, so run them
+            # concurrently; workers share this script's context for st.cache_data
+            with ThreadPoolExecutor(max_workers=QUERY_WORKERS, initializer=add_script_run_ctx,
+                                    initargs=(None, get_script_run_ctx())) as executor:
+                # Check for a newer table version while loading with the last one
+                version_check = executor.submit(get_table_version, engine)
+                cache_key = get_cache_key(version_check)
+                house_types = executor.submit(cached_load, load_house_type_counts, engine, cache_key)
+                localities = executor.submit(cached_load, load_locality_prices, engine, cache_key)
+                price_hist = cached_load(load_price_histogram, engine, cache_key)
+
+                # The histogram counts every house, so it decides between plotting
+                # the rows themselves and binning the whole table in Snowflake
+                df = space_rooms_density = year_price_density = None
+                if price_hist['NUM_HOUSES'].sum() > SCATTER_MAX_POINTS:
+                    space_rooms = executor.submit(cached_load, load_density, engine, cache_key,
+                                                  'LIVINGSPACE', 'NUMBERROOMS', y_bins=None)
+                    year_price = executor.submit(cached_load, load_density, engine, cache_key,
+                                                 'YEARBUILT', 'PRICE')
+                    space_rooms_density, year_price_density = space_rooms.result(), year_price.result()
+                elif not price_hist.empty:
+                    df = cached_load(load_data, engine, cache_key)
+                refresh_table_version(version_check)
+            house_type_counts = house_types.result()
+            top_5_expensive, top_5_cheap = localities.result()
+            if price_hist.empty:
+                st.warning("No houses with a valid price were found.")
+                return
+        except Exception as e:
+            st.error(f"Error loading data: {e}")
+            return
     
-    # Generate and display plots in the new order
-    plot_house_type_distribution(df)  # Previously 2nd
-    plot_living_space_vs_rooms(df)     # Previously 3rd
-    plot_year_built_vs_price(df)       # Previously 4th
-    plot_price_distribution(df)        # Moved to 4th position
-    plot_top_expensive_localities(df)  # Previously 5th
-    plot_top_cheap_localities(df)      # Previously 6th
+    # Generate and display plots in the new order. Figures built from small
+    # aggregates are shared via st.cache_resource (st.plotly_chart doesn't
+    # mutate them), which keeps only the figures for the current data; the
+    # scatter plots are rebuilt, since hashing their input would cost about as
+    # much as building them
+    st.plotly_chart(make_house_type_distribution(house_type_counts))  # Previously 2nd
+    st.plotly_chart(make_living_space_vs_rooms(df, space_rooms_density))     # Previously 3rd
+    st.plotly_chart(make_year_built_vs_price(df, year_price_density))       # Previously 4th
+    st.plotly_chart(make_price_distribution(price_hist))        # Moved to 4th position
+    st.plotly_chart(make_top_expensive_localities(top_5_expensive))  # Previously 5th
+    st.plotly_chart(make_top_cheap_localities(top_5_cheap))      # Previously 6th
 
 if __name__ == "__main__":
     main()